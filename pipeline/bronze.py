@@ -1,67 +1,255 @@
 """
 Bronze layer loader.
 
-Appends raw Socrata pages to bronze.buildings_raw in DuckDB.
+Writes raw Socrata pages as Parquet files, one partition per pipeline run,
+and exposes them in DuckDB as the view bronze.buildings_raw:
+
+    db/bronze/buildings_raw/run_id=<uuid>/part-00000.parquet
+                                         /part-00001.parquet ...
 
 Design notes:
-  - Append-only.  Rows are never updated or deleted here.
+  - Append-only.  Each run adds a new run_id=<uuid> partition; existing
+    files are never rewritten or deleted here.
   - Schema is inferred from the first page and then reused; all data columns
     arrive as Utf8 strings from Socrata (including numeric fields like
-    shape_area), so the schema is stable across pages.
-  - Three metadata columns are injected per row:
-      run_id            – UUID shared across all pages in one pipeline run
-      ingested_at       – UTC timestamp of the run start
-      source_dataset_id – Socrata dataset identifier
+    shape_area), so the schema is stable across pages.  The view reads the
+    files with union_by_name, so runs whose field sets differ still line up.
+  - run_id is stored only in the partition directory name.  The view reads
+    it back as a native UUID column via hive partitioning (hive_types), so
+    it costs nothing per row.  Per-run details (ingested_at,
+    source_dataset_id) live once in bronze.pipeline_runs (see state.py);
+    join on run_id, also a UUID there, to get them without casts.
   - the_geom is stored as a plain VARCHAR (GeoJSON string).  Silver will
     parse it with ST_GeomFromGeoJSON() via the DuckDB spatial extension.
-  - Table creation is lazy: the first call to append() creates the table by
-    reflecting the DataFrame schema; subsequent calls just INSERT.
+  - File writes aren't covered by the DuckDB transaction.  A run writes into
+    a staging directory; publish() moves it into place and refreshes the
+    view just before commit, and discard() deletes it on failure (the
+    rollback analogue).  Visibility is still transactional: the view only
+    shows partitions whose run_id has a committed bronze.pipeline_runs
+    header, so a partition left behind by a crash between publish() and
+    commit stays hidden.  prepare() clears staging left by crashed runs.
+  - Pages arrive as pyarrow Tables (anything with a to_arrow() method, e.g.
+    a polars DataFrame, is exported to Arrow first) and are written through
+    DuckDB's relation API (from_arrow -> write_parquet), which scans the
+    Arrow buffers directly.
+  - append_json() is the server-side alternative: DuckDB fetches the SODA
+    JSON pages itself via httpfs + read_json and COPYs the result straight
+    to Parquet, so rows never materialise as Python objects.
 """
 
-import polars as pl
+import glob
+import os
+import shutil
+
+from pipeline.config import BRONZE_DIR, SOCRATA_APP_TOKEN, SOCRATA_DOMAIN
 
 _SCHEMA = "bronze"
-_TABLE = f"{_SCHEMA}.buildings_raw"
+_NAME = "buildings_raw"
+_VIEW = f"{_SCHEMA}.{_NAME}"
+_RUNS_TABLE = f"{_SCHEMA}.pipeline_runs"
+
+_DATA_DIR = os.path.join(BRONZE_DIR, _NAME)
+_STAGING_DIR = os.path.join(BRONZE_DIR, "_staging", _NAME)
+# Stored in the view definition inside the database file, so it must be
+# absolute: a relative glob would resolve against whatever directory the
+# database happens to be opened from.
+_PARQUET_GLOB = os.path.join(os.path.abspath(_DATA_DIR), "*", "*.parquet")
+
+_TABLE_TYPE_SQL = """
+    SELECT table_type FROM information_schema.tables
+    WHERE table_schema = ? AND table_name = ?
+"""
+
+_COLUMNS_SQL = """
+    SELECT column_name FROM information_schema.columns
+    WHERE table_schema = ? AND table_name = ?
+"""
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+_CREATE_VIEW_SQL = f"""
+    CREATE OR REPLACE VIEW {_VIEW} AS
+    SELECT * FROM read_parquet(
+        {_quote(_PARQUET_GLOB)},
+        hive_partitioning = true,
+        hive_types = {{'run_id': UUID}},
+        union_by_name = true
+    )
+    WHERE run_id IN (SELECT run_id FROM {_RUNS_TABLE})
+"""
+
+
+def _partition(root, run_id):
+    return os.path.join(root, f"run_id={run_id}")
 
 
-def _ensure_table(conn, df):
+def _next_part(run_id):
+    """Return the path for the run's next staged Parquet file."""
+    run_dir = _partition(_STAGING_DIR, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    return os.path.join(run_dir, f"part-{len(os.listdir(run_dir)):05d}.parquet")
+
+
+def _migrate_legacy_table(conn):
     """
-    Create bronze.buildings_raw if it doesn't exist, deriving the schema
-    from the supplied DataFrame.  The bronze schema itself is guaranteed to
-    exist before any data transaction begins (state.ensure() creates it).
+    Convert a bronze.buildings_raw *table*, from before bronze moved to
+    Parquet, into run partitions so the view can take its name.
+
+    Each run's rows are COPYed out to a run_id=<uuid> partition.  Tables old
+    enough to carry ingested_at / source_dataset_id per row also get their
+    pipeline_runs headers back-filled, so the view's committed-run filter
+    keeps showing them.  The table is dropped and the view created in one
+    transaction; if this is interrupted the table survives and the next run
+    simply migrates again.
     """
-    exists = conn.execute(
+    row = conn.execute(_TABLE_TYPE_SQL, [_SCHEMA, _NAME]).fetchone()
+    if row is None or row[0] != "BASE TABLE":
+        return
+
+    print(f"Migrating {_VIEW} table to Parquet partitions...")
+    columns = {r[0] for r in conn.execute(_COLUMNS_SQL, [_SCHEMA, _NAME]).fetchall()}
+    per_row_meta = [c for c in ("ingested_at", "source_dataset_id") if c in columns]
+    exclude = f" EXCLUDE ({', '.join(per_row_meta)})" if per_row_meta else ""
+
+    legacy_dir = os.path.join(_STAGING_DIR, "_legacy")
+    shutil.rmtree(legacy_dir, ignore_errors=True)
+    os.makedirs(_STAGING_DIR, exist_ok=True)
+    conn.execute(
         f"""
-        SELECT COUNT(*) FROM information_schema.tables
-        WHERE table_schema = '{_SCHEMA}' AND table_name = 'buildings_raw'
+        COPY (SELECT *{exclude} FROM {_VIEW})
+        TO {_quote(legacy_dir)} (FORMAT parquet, PARTITION_BY (run_id), COMPRESSION zstd)
         """
-    ).fetchone()[0]
+    )
+
+    conn.begin()
+    try:
+        if per_row_meta == ["ingested_at", "source_dataset_id"]:
+            conn.execute(
+                f"""
+                INSERT INTO {_RUNS_TABLE} (run_id, ingested_at, source_dataset_id)
+                SELECT DISTINCT CAST(run_id AS UUID), ingested_at, source_dataset_id
+                FROM {_VIEW}
+                ON CONFLICT DO NOTHING
+                """
+            )
+        conn.execute(f"DROP TABLE {_VIEW}")
+
+        if os.path.isdir(legacy_dir):
+            os.makedirs(_DATA_DIR, exist_ok=True)
+            for partition in os.listdir(legacy_dir):
+                target = os.path.join(_DATA_DIR, partition)
+                # Left over from an interrupted migration; same rows.
+                shutil.rmtree(target, ignore_errors=True)
+                os.replace(os.path.join(legacy_dir, partition), target)
+        if glob.glob(_PARQUET_GLOB):
+            conn.execute(_CREATE_VIEW_SQL)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    shutil.rmtree(legacy_dir, ignore_errors=True)
 
-    if not exists:
-        conn.register("_schema_ref", df)
+
+def prepare(conn):
+    """
+    Setup before the data transaction begins (auto-committed), after
+    state.ensure().
+
+    Deletes the staging area: anything in it belongs to a run that died
+    before publish(), and only one run can hold the database at a time.
+    Then migrates a pre-Parquet bronze.buildings_raw table, if there is one,
+    so publish() can create the view before any data is fetched.
+    """
+    shutil.rmtree(_STAGING_DIR, ignore_errors=True)
+    _migrate_legacy_table(conn)
+
+
+def append(conn, page, run_id):
+    """
+    Write one batch of raw Socrata data to the run's staged partition.
+
+    page is a pyarrow Table, or any frame with a to_arrow() method.  Each
+    call writes one Parquet file.  Returns the number of rows written.
+    """
+    tbl = page.to_arrow() if hasattr(page, "to_arrow") else page
+    conn.from_arrow(tbl).write_parquet(_next_part(run_id), compression="zstd")
+    return tbl.num_rows
+
+
+def enable_remote(conn):
+    """
+    Load httpfs and register the Socrata app token as an HTTP header.
+
+    Must run before the data transaction begins (auto-committed setup), like
+    state.ensure().  Without a token Socrata still serves requests, just with
+    stricter throttling.
+    """
+    conn.execute("INSTALL httpfs; LOAD httpfs; INSTALL json; LOAD json;")
+    if SOCRATA_APP_TOKEN:
         conn.execute(
-            f"CREATE TABLE {_TABLE} AS SELECT * FROM _schema_ref WHERE 1=0"
+            f"""
+            CREATE OR REPLACE TEMPORARY SECRET socrata (
+                TYPE http,
+                EXTRA_HTTP_HEADERS MAP {{'X-App-Token': {_quote(SOCRATA_APP_TOKEN)}}},
+                SCOPE {_quote(f"https://{SOCRATA_DOMAIN}")}
+            )
+            """
         )
-        conn.unregister("_schema_ref")
 
 
-def append(conn, df, run_id, ingested_at, source_dataset_id):
+def append_json(conn, urls, fields, run_id):
     """
-    Append one page of raw Socrata data to bronze.buildings_raw.
+    Ingest SODA JSON pages into the run's staged partition entirely inside
+    DuckDB.
 
-    Metadata columns are appended on the right so they don't interfere with
-    the raw field layout.  Returns the number of rows written.
+    urls / fields come from extract.page_urls().  Every field is read as
+    VARCHAR except the_geom, which is read as JSON and stored as its text,
+    matching what the Python path produces.  DuckDB reads the URLs with its
+    own worker threads.  Returns the number of rows written.
     """
-    df = df.with_columns(
-        pl.lit(run_id).alias("run_id"),
-        pl.lit(ingested_at).alias("ingested_at"),
-        pl.lit(source_dataset_id).alias("source_dataset_id"),
+    if not urls:
+        return 0
+
+    columns = ", ".join(
+        f"{_quote(f)}: {_quote('JSON' if f == 'the_geom' else 'VARCHAR')}"
+        for f in fields
     )
+    return conn.execute(
+        f"""
+        COPY (
+            SELECT * REPLACE (CAST(the_geom AS VARCHAR) AS the_geom)
+            FROM read_json(
+                [{", ".join(_quote(u) for u in urls)}],
+                format = 'array',
+                columns = {{{columns}}}
+            )
+        ) TO {_quote(_next_part(run_id))} (FORMAT parquet, COMPRESSION zstd)
+        """
+    ).fetchone()[0]
+
+
+def publish(conn, run_id):
+    """
+    Move the run's staged files into bronze.buildings_raw.
+
+    Call inside the data transaction, immediately before commit: the view
+    refresh and the run's pipeline_runs header commit together, and until
+    then the view filters the new partition out.  If the commit itself
+    fails, discard() removes the published partition again.
+    """
+    staged = _partition(_STAGING_DIR, run_id)
+    if not os.path.isdir(staged):
+        return  # nothing was written (e.g. an empty incremental run)
 
-    _ensure_table(conn, df)
+    os.makedirs(_DATA_DIR, exist_ok=True)
+    os.replace(staged, _partition(_DATA_DIR, run_id))
+    conn.execute(_CREATE_VIEW_SQL)
 
-    conn.register("_bronze_batch", df)
-    conn.execute(f"INSERT INTO {_TABLE} SELECT * FROM _bronze_batch")
-    conn.unregister("_bronze_batch")
 
-    return len(df)
+def discard(run_id):
+    """Delete everything a failed run wrote, staged or already published."""
+    for root in (_STAGING_DIR, _DATA_DIR):
+        shutil.rmtree(_partition(root, run_id), ignore_errors=True)
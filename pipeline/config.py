@@ -12,5 +12,40 @@ BUILDINGS_DATASET_ID = "5zhs-2jue"
 
 DB_PATH = "db/nyc_buildings.duckdb"
 
+# Bronze Parquet files, one run_id=<uuid> partition per run (see bronze.py).
+BRONZE_DIR = os.path.join(os.path.dirname(DB_PATH), "bronze")
+
+# DuckDB settings for the bronze Parquet writes.  Row order within a run's
+# files isn't meaningful, and dropping it lets the Parquet writer run in
+# parallel; large writes spill to temp_directory instead of failing.
+DUCKDB_CONFIG = {
+    "threads": os.cpu_count() or 1,
+    "memory_limit": os.getenv("DUCKDB_MEMORY_LIMIT", "4GB"),
+    "preserve_insertion_order": "false",
+    "temp_directory": os.path.join(os.path.dirname(DB_PATH), "tmp"),
+}
+
 # Socrata hard ceiling per request
 PAGE_SIZE = 50_000
+
+# Concurrent page fetches in flight at once.
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+if FETCH_WORKERS < 1:
+    # With no workers nothing is fetched and the run would "succeed" with
+    # zero rows, advancing the watermark past data it never loaded.
+    raise ValueError(f"FETCH_WORKERS must be at least 1, got {FETCH_WORKERS}")
+
+# Converted pages that may wait for the writer.  When the queue is full the
+# fetch workers block, so at most FETCH_WORKERS + FETCH_QUEUE_SIZE pages are
+# held in memory regardless of network or writer speed.
+FETCH_QUEUE_SIZE = 4
+
+# HTTP 429 (rate limited) handling: retries per page and the base delay in
+# seconds, doubled on each attempt unless Socrata sends Retry-After.
+FETCH_MAX_RETRIES = 5
+FETCH_BACKOFF_SECONDS = 2.0
+
+# Pages are buffered and written to bronze in batches of at least this many
+# rows; each batch becomes one Parquet file, so this keeps files few and
+# their row groups (122,880 rows in DuckDB's writer) full.
+BRONZE_BATCH_ROWS = 200_000
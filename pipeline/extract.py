@@ -4,20 +4,37 @@ Socrata extraction layer.
 Responsibilities:
   - Metadata pre-flight check (skip run if source unchanged)
   - Row-count queries for progress reporting
-  - Paginated fetch with watermark filtering
-  - In-place geometry serialization (dict -> JSON string) so every DataFrame
+  - Concurrent paginated fetch with watermark filtering, handed to the
+    writer through a bounded queue
+  - In-place geometry serialization (dict -> JSON string) so every page
     that leaves this module has a consistent Utf8 the_geom column rather than
     a nested Struct, which DuckDB can store as VARCHAR and later parse with
     ST_GeomFromGeoJSON().
+  - Row -> column pivot straight into a pyarrow Table, which both sides of
+    the bronze handoff read natively (no intermediate DataFrame).
+  - Page URL planning for the server-side path, where DuckDB reads the
+    SODA JSON endpoints itself (httpfs + read_json) and no rows pass
+    through Python.
 """
 
-import json
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
-import polars as pl
+import orjson
+import pyarrow as pa
 import requests
+from requests.adapters import HTTPAdapter
 from sodapy import Socrata
 
 from pipeline.config import (
+    FETCH_BACKOFF_SECONDS,
+    FETCH_MAX_RETRIES,
+    FETCH_QUEUE_SIZE,
+    FETCH_WORKERS,
     PAGE_SIZE,
     SOCRATA_APP_TOKEN,
     SOCRATA_DOMAIN,
@@ -25,25 +42,87 @@ from pipeline.config import (
 )
 
 
+def _pooled(session):
+    """
+    Mount a keep-alive connection pool large enough for every fetch worker.
+
+    requests' default pool keeps 10 connections per host; with more
+    FETCH_WORKERS than that, surplus connections are closed after each page
+    and the next request pays a fresh TCP + TLS handshake.  Compression
+    needs nothing here: requests already sends Accept-Encoding gzip/deflate
+    (plus br when brotli is installed).
+    """
+    adapter = HTTPAdapter(pool_maxsize=max(FETCH_WORKERS, 10))
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by metadata requests so repeat calls reuse the same connection.
+_SESSION = _pooled(requests.Session())
+
+
 def get_client():
-    return Socrata(SOCRATA_DOMAIN, app_token=SOCRATA_APP_TOKEN, timeout=SOCRATA_TIMEOUT)
+    """
+    Build the Socrata client.  Create one per run and pass it around: its
+    requests.Session holds the pooled connections that pages are fetched on.
+    """
+    client = Socrata(SOCRATA_DOMAIN, app_token=SOCRATA_APP_TOKEN, timeout=SOCRATA_TIMEOUT)
+    _pooled(client.session)
+    return client
 
 
-def get_dataset_updated_at(dataset_id):
+def get_dataset_updated_at(dataset_id, etag=None, known_updated_at=None):
     """
-    Return the rowsUpdatedAt Unix epoch (int) from the Socrata metadata endpoint.
+    Return (rowsUpdatedAt: int | None, etag: str | None) from the Socrata
+    metadata endpoint.
 
-    This is a cheap HEAD-style check: if the value hasn't advanced since the
+    This is a cheap pre-flight check: if the value hasn't advanced since the
     last recorded run, the pipeline can skip the fetch entirely.
-    Returns None if the field is absent (treat as unknown / always fetch).
+    rowsUpdatedAt is None if the field is absent (treat as unknown / always
+    fetch).
+
+    Pass the etag and rowsUpdatedAt stored from the last run to make the
+    request conditional (If-None-Match).  If the metadata hasn't changed
+    Socrata answers 304 with no body and known_updated_at is returned as-is,
+    skipping the download and parse of the full metadata document.
     """
     url = f"https://{SOCRATA_DOMAIN}/api/views/{dataset_id}.json"
-    resp = requests.get(url, timeout=30)
+    headers = {"If-None-Match": etag} if etag else {}
+    resp = _SESSION.get(url, headers=headers, timeout=30)
+    if resp.status_code == 304:
+        return known_updated_at, etag
     resp.raise_for_status()
-    return resp.json().get("rowsUpdatedAt")
+    return resp.json().get("rowsUpdatedAt"), resp.headers.get("ETag")
+
+
+# Socrata's row identifier.  Offset paging is only deterministic under a
+# total order: without one, concurrent (or retried) page requests can see
+# rows in different orders and skip or duplicate them across pages.
+_PAGE_ORDER = ":id"
+
+
+def _watermark_where(watermark_ts):
+    """
+    Build the incremental filter.  Called once per run; the page workers
+    share the resulting string through their query params.
+    """
+    if watermark_ts is None:
+        return None
+    # Socrata floating timestamp format (no timezone suffix)
+    ts_str = watermark_ts.replace(tzinfo=None).isoformat(timespec="milliseconds")
+    return f"last_edited_date > '{ts_str}'"
+
+
+def _target_rows(client, dataset_id, where, row_limit):
+    total_rows = _row_count(client, dataset_id, where=where)
+    if row_limit is not None:
+        total_rows = min(total_rows, row_limit)
+    print(f"Target rows : {total_rows:,}")
+    return total_rows
 
 
 def _row_count(client, dataset_id, where=None):
+    # Must use the same where as the page requests it is reported against.
     params = {"select": "COUNT(*)"}
     if where:
         params["where"] = where
@@ -56,26 +135,111 @@ def _serialize_geom(records):
     Serialize the_geom from a Python dict (GeoJSON) to a JSON string in-place.
 
     sodapy deserializes the Socrata GeoJSON geometry into a nested Python dict.
-    Polars would auto-infer this as a Struct, which is inconvenient for storage
+    Arrow would infer this as a Struct, which is inconvenient for storage
     and later spatial parsing.  Converting to a plain string here keeps the
     schema predictable across all pages and lets DuckDB handle it as VARCHAR.
+    orjson is used rather than json: this runs once per row and the stdlib
+    encoder dominates page-processing time.
     """
     for record in records:
         geom = record.get("the_geom")
         if isinstance(geom, dict):
-            record["the_geom"] = json.dumps(geom)
+            record["the_geom"] = orjson.dumps(geom).decode()
         elif geom is None:
             record["the_geom"] = None
     return records
 
 
+def _to_arrow(records, schema=None):
+    """
+    Pivot a page of Socrata records into a pyarrow Table.
+
+    Socrata omits null fields from each record, so the column set is the
+    union of keys across the page and missing values become nulls.
+
+    For the first page (schema=None) columns are ordered by first appearance
+    and types are inferred.  A field that is null throughout is typed as a
+    string, since every Socrata field arrives as one (the_geom included, once
+    serialized).  Pass the first page's schema for later pages: construction
+    then skips type inference and every page shares one layout.  Fields not
+    seen before are appended as strings rather than dropped.
+    """
+    if schema is None:
+        columns = dict.fromkeys(key for record in records for key in record)
+        tbl = pa.Table.from_pydict(
+            {col: [record.get(col) for record in records] for col in columns}
+        )
+        return tbl.cast(
+            pa.schema(
+                pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                for f in tbl.schema
+            )
+        )
+
+    for name in sorted(set().union(*records).difference(schema.names)):
+        schema = schema.append(pa.field(name, pa.string()))
+    return pa.Table.from_pylist(records, schema=schema)
+
+
+def _get_page(client, dataset_id, params):
+    """
+    Fetch a single page, backing off on HTTP 429 (rate limited).
+
+    Honours Retry-After when Socrata sends it, otherwise doubles the delay on
+    each attempt.  Any other HTTP error is raised immediately.
+    """
+    for attempt in range(FETCH_MAX_RETRIES + 1):
+        try:
+            return client.get(dataset_id, **params)
+        except requests.HTTPError as e:
+            resp = e.response
+            if resp is None or resp.status_code != 429 or attempt == FETCH_MAX_RETRIES:
+                raise
+            retry_after = resp.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = FETCH_BACKOFF_SECONDS * 2**attempt
+            time.sleep(delay)
+
+
+def _put(q, item, stop):
+    """Block on a full queue, but give up once stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
 def fetch_pages(client, dataset_id, watermark_ts=None, row_limit=None):
     """
-    Generator that yields (page: pl.DataFrame, total_rows: int).
+    Generator that yields (page: pa.Table, total_rows: int | None).
 
     On a full load (watermark_ts=None) this will page through the entire
     dataset.  On an incremental run it filters to records edited after the
-    watermark, keeping memory usage bounded at PAGE_SIZE rows at a time.
+    watermark.
+
+    FETCH_WORKERS threads each claim the next page offset, fetch it, convert
+    it to Arrow and put it on a queue of FETCH_QUEUE_SIZE pages, which this
+    generator drains.  Pages therefore arrive in completion order, not offset
+    order.  Every page request is ordered by Socrata's :id so the offsets
+    partition the result set exactly.  When the caller (the DuckDB writer)
+    falls behind, the queue fills and workers block before fetching more,
+    so memory stays bounded at roughly FETCH_WORKERS + FETCH_QUEUE_SIZE
+    pages however fast the network is.
+
+    There is no up-front COUNT(*): offsets are requested until a page comes
+    back short, which marks the end of the data.  The count is still issued,
+    on its own background thread alongside the first pages, purely for
+    progress reporting; total_rows is None until it arrives (or if it
+    fails).  The generator never waits on it, not even when it finishes or
+    is closed.
+
+    A fetch error in any worker is re-raised here.  Closing the generator
+    early (or an error in the caller, when it is wrapped in
+    contextlib.closing) stops the workers and waits for them to exit.
 
     Parameters
     ----------
@@ -86,37 +250,115 @@ def fetch_pages(client, dataset_id, watermark_ts=None, row_limit=None):
         Cap the total number of rows fetched.  Useful for testing without
         pulling the full dataset.
     """
-    where = None
-    if watermark_ts is not None:
-        # Socrata floating timestamp format (no timezone suffix)
-        ts_str = watermark_ts.strftime("%Y-%m-%dT%H:%M:%S.000")
-        where = f"last_edited_date > '{ts_str}'"
+    where = _watermark_where(watermark_ts)
+    query_params = {"order": _PAGE_ORDER}
+    if where:
+        query_params["where"] = where
 
-    total_rows = _row_count(client, dataset_id, where=where)
-    if row_limit is not None:
-        total_rows = min(total_rows, row_limit)
-    print(f"Target rows : {total_rows:,}")
+    if row_limit is None:
+        offsets = itertools.count(0, PAGE_SIZE)
+    else:
+        offsets = iter(range(0, row_limit, PAGE_SIZE))
 
-    if total_rows == 0:
-        return
+    pages = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+    stop = threading.Event()
+    offsets_lock = threading.Lock()
+    schema_lock = threading.Lock()
+    end = None  # first offset past the data, once a short page has been seen
+    schema = None  # fixed from the first page onwards, see _to_arrow()
+    done = object()  # per-worker end-of-stream marker
 
-    query_params = {}
-    if where:
-        query_params["where"] = where
+    def claim():
+        with offsets_lock:
+            offset = next(offsets, None)
+            if offset is None or (end is not None and offset >= end):
+                return None, None
+            limit = PAGE_SIZE if row_limit is None else min(PAGE_SIZE, row_limit - offset)
+            return offset, limit
+
+    def worker():
+        nonlocal end, schema
+        try:
+            while not stop.is_set():
+                offset, limit = claim()
+                if offset is None:
+                    break
+                params = dict(query_params, limit=limit, offset=offset)
+                page = _get_page(client, dataset_id, params)
+                if len(page) < limit:
+                    # Short page – the data ends here, stop claiming past it
+                    with offsets_lock:
+                        page_end = offset + len(page)
+                        end = page_end if end is None else min(end, page_end)
+                if page:
+                    _serialize_geom(page)
+                    with schema_lock:
+                        tbl = _to_arrow(page, schema)
+                        schema = tbl.schema
+                    _put(pages, tbl, stop)
+            _put(pages, done, stop)
+        except Exception as e:
+            _put(pages, e, stop)
+
+    counted = []  # [total_rows] once the count arrives
 
-    offset = 0
-    while offset < total_rows:
-        query_params["limit"] = PAGE_SIZE
-        query_params["offset"] = offset
+    def count():
+        try:
+            total = _row_count(client, dataset_id, where)
+        except Exception:
+            return  # progress only; total_rows stays None
+        counted.append(total if row_limit is None else min(total, row_limit))
 
-        page = client.get(dataset_id, **query_params)
-        if not page:
-            break
+    # Daemon thread, never joined: a slow COUNT can't delay teardown or exit.
+    threading.Thread(target=count, daemon=True).start()
+    pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+    try:
+        for _ in range(FETCH_WORKERS):
+            pool.submit(worker)
+
+        running = FETCH_WORKERS
+        while running:
+            item = pages.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item, counted[0] if counted else None
+    finally:
+        # Runs on exhaustion, on a fetch error, and when the consumer stops
+        # early (generator closed).  Workers blocked on the full queue see
+        # stop within a poll interval; one mid-request finishes it and exits.
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def page_urls(client, dataset_id, watermark_ts=None, row_limit=None):
+    """
+    Plan a server-side ingest: return (urls: list[str], fields: list[str]).
+
+    urls are SODA JSON endpoints, one per PAGE_SIZE page, for DuckDB to read
+    directly with read_json.  fields are the dataset's column names from the
+    Socrata metadata, so the reader can be given an explicit all-VARCHAR
+    schema instead of auto-detecting types (which would turn timestamp
+    strings into TIMESTAMPs and diverge from the Python path).
+    Takes the same watermark_ts / row_limit arguments as fetch_pages().
+    """
+    where = _watermark_where(watermark_ts)
+    total_rows = _target_rows(client, dataset_id, where, row_limit)
 
-        _serialize_geom(page)
-        yield pl.DataFrame(page), total_rows
+    base = f"https://{SOCRATA_DOMAIN}/resource/{dataset_id}.json"
+    urls = []
+    for offset in range(0, total_rows, PAGE_SIZE):
+        params = {
+            "$order": _PAGE_ORDER,
+            "$limit": min(PAGE_SIZE, total_rows - offset),
+            "$offset": offset,
+        }
+        if where:
+            params["$where"] = where
+        urls.append(f"{base}?{urlencode(params)}")
 
-        offset += len(page)
-        # API returned a short page – we've hit the end
-        if len(page) < PAGE_SIZE:
-            break
+    fields = [col["fieldName"] for col in client.get_metadata(dataset_id)["columns"]]
+    return urls, fields
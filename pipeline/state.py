@@ -3,10 +3,15 @@ Watermark state management for the bronze pipeline.
 
 Tracks per-dataset run history in bronze.pipeline_state so the extractor
 knows whether to do a full load or an incremental pull.
+
+bronze.pipeline_runs holds one header row per ingested run (when it ran and
+from which dataset); bronze.buildings_raw rows carry only run_id and join
+back here for the rest.
 """
 
 _SCHEMA = "bronze"
 _TABLE = f"{_SCHEMA}.pipeline_state"
+_RUNS_TABLE = f"{_SCHEMA}.pipeline_runs"
 
 _INIT_DDL = f"""
     CREATE SCHEMA IF NOT EXISTS {_SCHEMA};
@@ -15,44 +20,87 @@ _INIT_DDL = f"""
         last_run_at         TIMESTAMP,
         dataset_updated_at  BIGINT,
         last_run_status     VARCHAR,
-        rows_ingested       INTEGER
+        rows_ingested       INTEGER,
+        etag                VARCHAR
+    );
+    ALTER TABLE {_TABLE} ADD COLUMN IF NOT EXISTS etag VARCHAR;
+    CREATE TABLE IF NOT EXISTS {_RUNS_TABLE} (
+        run_id              UUID PRIMARY KEY,
+        ingested_at         TIMESTAMPTZ,
+        source_dataset_id   VARCHAR
     );
 """
 
+# Statement text is built once here rather than formatted on every call.
+# Values are always bound as parameters, never interpolated.
+_GET_WATERMARK_SQL = f"""
+    SELECT last_run_at, dataset_updated_at, etag
+    FROM {_TABLE}
+    WHERE dataset_id = ?
+"""
+
+_SET_WATERMARK_SQL = f"""
+    INSERT INTO {_TABLE}
+        (dataset_id, last_run_at, dataset_updated_at, last_run_status,
+         rows_ingested, etag)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (dataset_id) DO UPDATE SET
+        last_run_at        = excluded.last_run_at,
+        dataset_updated_at = excluded.dataset_updated_at,
+        last_run_status    = excluded.last_run_status,
+        rows_ingested      = excluded.rows_ingested,
+        etag               = excluded.etag
+"""
+
+_RECORD_RUN_SQL = f"""
+    INSERT INTO {_RUNS_TABLE} (run_id, ingested_at, source_dataset_id)
+    VALUES (?, ?, ?)
+"""
+
 
 def ensure(conn):
-    """Create schema and state table if they don't exist (auto-committed DDL)."""
+    """Create schema, state and run tables if they don't exist (auto-committed DDL)."""
     conn.execute(_INIT_DDL)
 
 
 def get_watermark(conn, dataset_id):
     """
-    Return (last_run_at: datetime | None, dataset_updated_at: int | None).
+    Return (last_run_at: datetime | None, dataset_updated_at: int | None,
+            etag: str | None).
 
     last_run_at        – UTC timestamp of the last successful run; used as the
                          last_edited_date watermark on the next incremental pull.
     dataset_updated_at – rowsUpdatedAt epoch from Socrata metadata; used to
                          skip the run entirely if the source hasn't changed.
+    etag               – ETag of the metadata response dataset_updated_at was
+                         read from; lets the next check be conditional.
     """
     row = conn.execute(
-        f"SELECT last_run_at, dataset_updated_at FROM {_TABLE} WHERE dataset_id = ?",
+        _GET_WATERMARK_SQL,
         [dataset_id],
     ).fetchone()
-    return (row[0], row[1]) if row else (None, None)
+    return (row[0], row[1], row[2]) if row else (None, None, None)
 
 
-def set_watermark(conn, dataset_id, run_at, dataset_updated_at, status, rows_ingested):
+def set_watermark(
+    conn, dataset_id, run_at, dataset_updated_at, status, rows_ingested, etag=None
+):
     """Upsert a run record into the state table."""
     conn.execute(
-        f"""
-        INSERT INTO {_TABLE}
-            (dataset_id, last_run_at, dataset_updated_at, last_run_status, rows_ingested)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT (dataset_id) DO UPDATE SET
-            last_run_at        = excluded.last_run_at,
-            dataset_updated_at = excluded.dataset_updated_at,
-            last_run_status    = excluded.last_run_status,
-            rows_ingested      = excluded.rows_ingested
-        """,
-        [dataset_id, run_at, dataset_updated_at, status, rows_ingested],
+        _SET_WATERMARK_SQL,
+        [dataset_id, run_at, dataset_updated_at, status, rows_ingested, etag],
+    )
+
+
+def record_run(conn, run_id, ingested_at, source_dataset_id):
+    """
+    Insert the header row for a run.  run_id is a uuid.UUID, stored as a
+    native 16-byte UUID; ingested_at is a timezone-aware UTC datetime.
+
+    Call inside the data transaction so a rolled-back run leaves no header
+    behind, just as it leaves no rows in bronze.buildings_raw.
+    """
+    conn.execute(
+        _RECORD_RUN_SQL,
+        [run_id, ingested_at, source_dataset_id],
     )
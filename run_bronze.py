@@ -2,44 +2,73 @@
 Bronze pipeline entry point.
 
 Run this script weekly (cron, task scheduler, etc.) to ingest the NYC
-buildings dataset into the bronze layer of the DuckDB medallion store.
+buildings dataset into the bronze layer of the DuckDB medallion store
+(Parquet files per run, exposed as the bronze.buildings_raw view).
 
 Flow
 ----
 1. Pre-flight metadata check – compare Socrata's rowsUpdatedAt against the
    stored watermark.  Skip the run entirely if the source hasn't changed.
+   The request is conditional on the stored ETag, so an unchanged dataset
+   costs a bodiless 304.
 2. Determine load mode:
      Full load   – no prior successful run exists (first-time setup)
      Incremental – filter to records where last_edited_date > last_run_at
-3. Page through Socrata within a single DuckDB transaction.
-4. On success: commit + advance the watermark.
-   On failure:  rollback (no partial data in bronze) + record the error.
+3. Record the run in bronze.pipeline_runs and page through Socrata, all
+   within a single DuckDB transaction, writing pages to bronze in batches
+   of BRONZE_BATCH_ROWS.  With --server-side, DuckDB reads the SODA JSON
+   pages itself (httpfs + read_json) instead.
+4. On success: publish the run's Parquet partition, commit + advance the
+   watermark.
+   On failure:  rollback + delete the run's files (no partial data in
+   bronze) + record the error.
 
 Usage
 -----
-    python run_bronze.py              # full / incremental run
-    python run_bronze.py --limit 1000 # cap rows (testing / dry-run)
+    python run_bronze.py               # full / incremental run
+    python run_bronze.py --limit 1000  # cap rows (testing / dry-run)
+    python run_bronze.py --server-side # DuckDB fetches the JSON (httpfs)
 """
 
 import argparse
 import os
 import uuid
+from contextlib import closing
 from datetime import datetime, timezone
 
 import duckdb
+import pyarrow as pa
 
 from pipeline import bronze, extract, state
-from pipeline.config import BUILDINGS_DATASET_ID, DB_PATH
+from pipeline.config import (
+    BRONZE_BATCH_ROWS,
+    BUILDINGS_DATASET_ID,
+    DB_PATH,
+    DUCKDB_CONFIG,
+)
 
 
-def run(row_limit=None):
+def _flush(conn, pending, run_id):
+    """Write buffered pages to bronze as one append; returns rows written."""
+    # Pages share the first page's schema, but a field first seen on a later
+    # page widens it, so unify by name.
+    batch = pa.concat_tables(pending, promote_options="default")
+    return bronze.append(conn, batch, run_id)
+
+
+def run(row_limit=None, server_side=False):
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = duckdb.connect(DB_PATH)
+    conn = duckdb.connect(DB_PATH, config=DUCKDB_CONFIG)
 
     # --- Setup and watermark check (auto-committed, outside data transaction) ---
     state.ensure(conn)
-    last_run_at, last_dataset_ts = state.get_watermark(conn, BUILDINGS_DATASET_ID)
-    current_dataset_ts = extract.get_dataset_updated_at(BUILDINGS_DATASET_ID)
+    bronze.prepare(conn)
+    last_run_at, last_dataset_ts, last_etag = state.get_watermark(
+        conn, BUILDINGS_DATASET_ID
+    )
+    current_dataset_ts, current_etag = extract.get_dataset_updated_at(
+        BUILDINGS_DATASET_ID, etag=last_etag, known_updated_at=last_dataset_ts
+    )
 
     if (
         last_dataset_ts is not None
@@ -50,7 +79,7 @@ def run(row_limit=None):
         conn.close()
         return
 
-    run_id = str(uuid.uuid4())
+    run_id = uuid.uuid4()
     ingested_at = datetime.now(timezone.utc)
     is_full_load = last_run_at is None
     watermark = None if is_full_load else last_run_at
@@ -62,27 +91,53 @@ def run(row_limit=None):
         print(f"Mode   : incremental (since {watermark} UTC)")
 
     client = extract.get_client()
+    if server_side:
+        bronze.enable_remote(conn)
     total_ingested = 0
     success = False
 
     # --- Data ingestion (single transaction – rollback on any failure) ---
     conn.begin()
     try:
-        for page_df, total_rows in extract.fetch_pages(
-            client, BUILDINGS_DATASET_ID, watermark_ts=watermark, row_limit=row_limit
-        ):
-            rows = bronze.append(
-                conn, page_df, run_id, ingested_at, BUILDINGS_DATASET_ID
-            )
-            total_ingested += rows
-            print(f"  {total_ingested:,} / {total_rows:,} rows", end="\r")
+        state.record_run(conn, run_id, ingested_at, BUILDINGS_DATASET_ID)
 
+        if server_side:
+            urls, fields = extract.page_urls(
+                client, BUILDINGS_DATASET_ID, watermark_ts=watermark, row_limit=row_limit
+            )
+            total_ingested = bronze.append_json(conn, urls, fields, run_id)
+        else:
+            pending = []
+            pending_rows = 0
+            pages = extract.fetch_pages(
+                client, BUILDINGS_DATASET_ID, watermark_ts=watermark, row_limit=row_limit
+            )
+            # closing() stops the fetch workers before the rollback below if
+            # writing fails part-way.
+            with closing(pages):
+                for page, total_rows in pages:
+                    pending.append(page)
+                    pending_rows += page.num_rows
+                    if pending_rows >= BRONZE_BATCH_ROWS:
+                        total_ingested += _flush(conn, pending, run_id)
+                        pending, pending_rows = [], 0
+                    fetched = total_ingested + pending_rows
+                    if total_rows is None:
+                        print(f"  {fetched:,} rows", end="\r")
+                    else:
+                        print(f"  {fetched:,} / {total_rows:,} rows", end="\r")
+
+            if pending:
+                total_ingested += _flush(conn, pending, run_id)
+
+        bronze.publish(conn, run_id)
         conn.commit()
         success = True
         print(f"\nDone. Rows ingested : {total_ingested:,}")
 
     except Exception as e:
         conn.rollback()
+        bronze.discard(run_id)
         print(f"\nFailed after {total_ingested:,} rows: {e}")
         raise
 
@@ -96,6 +151,7 @@ def run(row_limit=None):
             current_dataset_ts if success else last_dataset_ts,
             "success" if success else "failed",
             total_ingested,
+            current_etag if success else last_etag,
         )
         conn.close()
 
@@ -106,5 +162,9 @@ if __name__ == "__main__":
         "--limit", type=int, default=None, metavar="N",
         help="Cap total rows fetched (useful for testing without a full pull).",
     )
+    parser.add_argument(
+        "--server-side", action="store_true",
+        help="Let DuckDB fetch the Socrata JSON directly (httpfs + read_json).",
+    )
     args = parser.parse_args()
-    run(row_limit=args.limit)
+    run(row_limit=args.limit, server_side=args.server_side)